@@ -20,7 +20,9 @@ def create_app():
 
     @app.route("/", methods=["GET"])
     def index():
-        return {"message": "Mock API. Only supports /v1/events/ endpoint."}
+        return {
+            "message": "Mock API. Only supports /v1/events/ and /v1/events/stats endpoints."
+        }
 
     # Register Blueprint
     from api import events
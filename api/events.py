@@ -1,52 +1,298 @@
-from flask import Blueprint, request, current_app
+import hashlib
+import json
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from flask import Blueprint, Response, request, current_app
 from markupsafe import escape
 
 from api.db import get_db
-from api.utils import is_valid_datetime
+from api.utils import (
+    SizedLRUCache,
+    compress,
+    get_supported_encodings,
+    is_closed_timeperiod,
+    is_valid_timeperiod,
+    parse_int,
+)
 
 bp = Blueprint("events", __name__, url_prefix="/v1/events/")
 
+# Columns of an event returned by the API. Excludes internal `seq` column
+EVENT_COLUMNS = [
+    "event",
+    "time",
+    "unique_visitor_id",
+    "ha_user_id",
+    "browser",
+    "os",
+    "country_code",
+]
+
+# Default and maximum number of events returned per change feed request
+FEED_DEFAULT_LIMIT = 1000
+FEED_MAX_LIMIT = 10000
+
+# Smaller responses are not worth compressing
+COMPRESSION_MIN_SIZE = 512
+
+# Maximum total size of response bodies cached for closed time periods and of
+# their compressed representations
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+COMPRESSED_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_closed_window_responses = SizedLRUCache(max_bytes=RESPONSE_CACHE_MAX_BYTES)
+_compressed_responses = SizedLRUCache(max_bytes=COMPRESSED_RESPONSE_CACHE_MAX_BYTES)
+
+# Dimensions supported by `group_by` parameter of stats endpoint
+STATS_DIMENSIONS = ["event", "country_code", "browser", "os", "time"]
+
+# Size of time bucket supported by `bucket` parameter of stats endpoint
+STATS_TIME_BUCKETS = {
+    "minute": "%Y-%m-%d %H:%M:00",
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d",
+}
+
+
+def _build_filter_statements(event_id: str, timeperiod: str) -> Tuple[str, List[str]]:
+    """Returns WHERE clause and its parameters for `event_id` and `timeperiod`
+    filters"""
+    conditions = []
+    params = []
+
+    if event_id:
+        conditions.append("event = ?")
+        params.append(event_id)
+
+    if timeperiod:
+        start, end = timeperiod.split("::")
+        conditions.append("time BETWEEN ? AND ?")
+        params.extend([start, end])
+
+    filter_statements = ""
+    if conditions:
+        filter_statements = "WHERE " + " AND ".join(conditions)
+
+    return filter_statements, params
+
 
 @bp.route("/", methods=["GET"])
 def fetch_events():
     event_id = escape(request.args.get("event_id", ""))
     timeperiod = escape(request.args.get("timeperiod", ""))
+    since = escape(request.args.get("since", ""))
+    limit = escape(request.args.get("limit", ""))
+
+    if timeperiod and not is_valid_timeperiod(timeperiod):
+        return {"message": f"Invalid timeperiod : {timeperiod}"}, 400
+
+    # Change feed i.e events inserted after `since` sequence in insertion order
+    if since:
+        since = parse_int(since)
+        limit = parse_int(limit) if limit else FEED_DEFAULT_LIMIT
+        if since is None or since < 0:
+            return {"message": "Invalid since parameter"}, 400
+
+        if limit is None or not (0 < limit <= FEED_MAX_LIMIT):
+            return {"message": f"limit must be between 1 and {FEED_MAX_LIMIT}"}, 400
+
+        formatted_response, last_seq = _fetch_events(
+            event_id, timeperiod, since=since, limit=limit
+        )
+
+        # Sequence to pass as `since` to fetch the next page
+        next_since = last_seq if last_seq is not None else since
+        return {"data": formatted_response, "next_since": next_since}
+
+    # Events of time periods which are fully in the past only change when new
+    # events are inserted. Serve them from cache with a strong ETag
+    if timeperiod and is_closed_timeperiod(timeperiod.split("::")[-1]):
+        body, etag = _fetch_closed_window_events(
+            current_app.config["DATABASE"], event_id, timeperiod, _get_last_seq()
+        )
+        response = current_app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    formatted_response, _ = _fetch_events(event_id, timeperiod)
+    return {"data": formatted_response}
 
+
+@bp.after_request
+def compress_response(response: Response) -> Response:
+    """Compress response body based on `Accept-Encoding` header and answer
+    `If-None-Match` requests with 304 for responses having ETag"""
+    response.vary.add("Accept-Encoding")
+
+    encoding = request.accept_encodings.best_match(get_supported_encodings())
+    if (
+        encoding
+        and response.status_code == 200
+        and not response.direct_passthrough
+        and "Content-Encoding" not in response.headers
+        and (response.content_length or 0) >= COMPRESSION_MIN_SIZE
+    ):
+        etag, _ = response.get_etag()
+        if etag:
+            # Compressed body of a cached response is also cached by its ETag
+            body = _compress_cached(etag, encoding, response)
+            response.set_etag(f"{etag}-{encoding}")
+        else:
+            body = compress(response.get_data(), encoding)
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+
+    return response.make_conditional(request)
+
+
+def _get_last_seq() -> int:
+    """Returns sequence of the most recently inserted event"""
     db = get_db()
     cur = db.cursor()
+    last_seq = cur.execute("SELECT MAX(seq) FROM raw_events").fetchone()[0]
+    return last_seq or 0
 
-    filter_statements = ""
-    if event_id:
-        filter_statements += f"WHERE event='{event_id}'"
 
-    if timeperiod:
-        start, end = timeperiod.split("::")
+def _fetch_closed_window_events(
+    database: str, event_id: str, timeperiod: str, last_seq: int
+) -> Tuple[bytes, str]:
+    """Cached JSON body and its ETag for events of a closed time period.
+    `last_seq` is part of the cache key so that late arriving events invalidate
+    the cache entries"""
+    cache_key = (database, event_id, timeperiod, last_seq)
+    cached = _closed_window_responses.get(cache_key)
+    if cached is not None:
+        return cached
 
-        if not is_valid_datetime(start):
-            current_app.logger.error(
-                f"Invalid start date in timeperiod parameter : {timeperiod}"
-            )
+    formatted_response, _ = _fetch_events(event_id, timeperiod)
+    body = json.dumps({"data": formatted_response}, separators=(",", ":")).encode()
+    etag = hashlib.sha256(body).hexdigest()
+    _closed_window_responses.put(cache_key, (body, etag), nbytes=len(body))
+    return body, etag
 
-        if not is_valid_datetime(end):
-            current_app.logger.error(
-                f"Invalid end date in timeperiod parameter : {timeperiod}"
-            )
 
-        if event_id:
-            filter_statements += " AND"
-        else:
-            filter_statements += "WHERE"
+def _compress_cached(etag: str, encoding: str, response: Response) -> bytes:
+    """Compressed body of response identified by `etag`"""
+    body = _compressed_responses.get((etag, encoding))
+    if body is None:
+        body = compress(response.get_data(), encoding)
+        _compressed_responses.put((etag, encoding), body, nbytes=len(body))
+
+    return body
+
+
+def _fetch_events(
+    event_id: str,
+    timeperiod: str,
+    since: Optional[int] = None,
+    limit: Optional[int] = None,
+) -> Tuple[List[dict], Optional[int]]:
+    """Returns formatted events along with the sequence of the last event"""
+    db = get_db()
+    cur = db.cursor()
 
-        filter_statements += f" time BETWEEN '{start}' AND '{end}'"
+    filter_statements, params = _build_filter_statements(event_id, timeperiod)
 
-    query = f"SELECT * FROM raw_events {filter_statements}"
+    query = (
+        f"SELECT seq, {', '.join(EVENT_COLUMNS)} FROM raw_events {filter_statements}"
+    )
 
-    data = cur.execute(query).fetchall()
+    if since is not None:
+        query += " AND" if filter_statements else " WHERE"
+        query += " seq > ? ORDER BY seq LIMIT ?"
+        params.extend([since, limit])
+
+    data = cur.execute(query, params).fetchall()
 
     formatted_response = []
     for row in data:
         formatted_row = dict(row)
+        del formatted_row["seq"]
         event = formatted_row.pop("event")
         formatted_response.append({"event": event, "properties": formatted_row})
 
-    return {"data": formatted_response}
+    last_seq = data[-1]["seq"] if data else None
+    return formatted_response, last_seq
+
+
+@bp.route("/stats", methods=["GET"])
+def fetch_events_stats():
+    event_id = escape(request.args.get("event_id", ""))
+    timeperiod = escape(request.args.get("timeperiod", ""))
+    group_by = escape(request.args.get("group_by", "event"))
+    bucket = escape(request.args.get("bucket", "hour"))
+
+    dimensions = tuple(dim.strip() for dim in group_by.split(",") if dim.strip())
+    invalid_dimensions = [dim for dim in dimensions if dim not in STATS_DIMENSIONS]
+    if invalid_dimensions:
+        return {
+            "message": f"Invalid group_by dimensions : {', '.join(invalid_dimensions)}"
+        }, 400
+
+    if bucket not in STATS_TIME_BUCKETS:
+        return {"message": f"Invalid bucket : {bucket}"}, 400
+
+    if timeperiod and not is_valid_timeperiod(timeperiod):
+        return {"message": f"Invalid timeperiod : {timeperiod}"}, 400
+
+    # Aggregates of time periods which are fully in the past do not change
+    if timeperiod and is_closed_timeperiod(timeperiod.split("::")[-1]):
+        data = _fetch_closed_window_stats(
+            current_app.config["DATABASE"],
+            event_id,
+            timeperiod,
+            dimensions,
+            bucket,
+            _get_last_seq(),
+        )
+    else:
+        data = _fetch_stats(event_id, timeperiod, dimensions, bucket)
+
+    return {"data": data}
+
+
+@lru_cache(maxsize=1024)
+def _fetch_closed_window_stats(
+    database: str,
+    event_id: str,
+    timeperiod: str,
+    dimensions: Tuple[str, ...],
+    bucket: str,
+    last_seq: int,
+) -> List[dict]:
+    """Cached aggregates of a closed time period. `database` and `last_seq` are
+    part of the cache key so that each database has its own cache entries and late
+    arriving events invalidate them"""
+    return _fetch_stats(event_id, timeperiod, dimensions, bucket)
+
+
+def _fetch_stats(
+    event_id: str, timeperiod: str, dimensions: Tuple[str, ...], bucket: str
+) -> List[dict]:
+    """Count events per group of `dimensions` using GROUP BY query"""
+    db = get_db()
+    cur = db.cursor()
+
+    filter_statements, params = _build_filter_statements(event_id, timeperiod)
+
+    select_columns = []
+    for dim in dimensions:
+        if dim == "time":
+            dim = f"strftime('{STATS_TIME_BUCKETS[bucket]}', time) AS time"
+        select_columns.append(dim)
+
+    # Group by position of the selected columns
+    group_statements = ""
+    if dimensions:
+        positions = ", ".join(str(i) for i in range(1, len(dimensions) + 1))
+        group_statements = f"GROUP BY {positions} ORDER BY {positions}"
+
+    select_columns.append("COUNT(*) AS nevents")
+
+    query = f"SELECT {', '.join(select_columns)} FROM raw_events {filter_statements} {group_statements}"
+
+    data = cur.execute(query, params).fetchall()
+
+    return [dict(row) for row in data]
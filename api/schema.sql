@@ -1,6 +1,8 @@
 DROP TABLE IF EXISTS raw_events;
 
+-- `seq` is a monotonic ingest sequence used by the change feed
 CREATE TABLE raw_events ( 
+	seq                  integer NOT NULL  PRIMARY KEY  AUTOINCREMENT   ,
 	event                varchar NOT NULL    ,
 	time                 datetime NOT NULL    ,
 	unique_visitor_id    varchar NOT NULL    ,
@@ -8,5 +10,8 @@ CREATE TABLE raw_events (
 	browser              varchar(128)     ,
 	os                   varchar(64)     ,
 	country_code         varchar(256)     ,
-	CONSTRAINT PrimaryKey PRIMARY KEY ( event, time, unique_visitor_id )
+	CONSTRAINT PrimaryKey UNIQUE ( event, time, unique_visitor_id )
  );
+
+-- Covering index for time period filters and stats GROUP BY queries
+CREATE INDEX raw_events_time_idx ON raw_events ( time, event, country_code, browser, os );
@@ -1,4 +1,13 @@
+import gzip
+import threading
+from collections import OrderedDict
 from datetime import datetime
+from typing import Any, Hashable, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def is_valid_datetime(datetime_str: str) -> bool:
@@ -9,3 +18,81 @@ def is_valid_datetime(datetime_str: str) -> bool:
         return False
 
     return True
+
+
+def is_valid_timeperiod(timeperiod: str) -> bool:
+    """Checks whether `timeperiod` is formatted as `<start>::<end>` datetimes"""
+    bounds = timeperiod.split("::")
+    return len(bounds) == 2 and all(is_valid_datetime(bound) for bound in bounds)
+
+
+def is_closed_timeperiod(end_datetime_str: str) -> bool:
+    """Checks whether time period ending at `end_datetime_str` is fully in the past"""
+    date_format = "%Y-%m-%d %H:%M:%S"
+    try:
+        end = datetime.strptime(end_datetime_str, date_format)
+    except ValueError as _:
+        return False
+
+    return end < datetime.now()
+
+
+def parse_int(value: str) -> Optional[int]:
+    try:
+        return int(value)
+    except ValueError as _:
+        return None
+
+
+def get_supported_encodings() -> List[str]:
+    """Returns supported response content encodings in order of preference.
+    `zstd` is only supported if optional `zstandard` package is installed"""
+    encodings = ["gzip"]
+    if zstandard is not None:
+        encodings.insert(0, "zstd")
+
+    return encodings
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+
+    return gzip.compress(data, compresslevel=6)
+
+
+class SizedLRUCache(object):
+    """LRU cache bounded by total size of the cached values in bytes. Values larger
+    than `max_bytes` are never cached"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._data:
+                return None
+
+            self._data.move_to_end(key)
+            value, _ = self._data[key]
+            return value
+
+    def put(self, key: Hashable, value: Any, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._data:
+                _, replaced_nbytes = self._data.pop(key)
+                self.nbytes -= replaced_nbytes
+
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            # Evict least recently used values
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._data.popitem(last=False)
+                self.nbytes -= evicted_nbytes
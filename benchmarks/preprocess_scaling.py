@@ -0,0 +1,83 @@
+"""Benchmark wall time of the `preprocess` stage with different number of workers
+on generated raw events. The stage runs against a temporary intermediate data store.
+
+Usage: python -m benchmarks.preprocess_scaling [--nevents 1000000] [--workers 1,2,4,8]
+"""
+
+import os
+import pickle
+import tempfile
+import time
+import uuid
+
+import click
+import numpy as np
+import pandas as pd
+
+COUNTRY_CODES = ["IT", "FR", "US", "United States", "Italy", "NL", "DE", "ES", "NO"]
+
+
+def generate_raw_events(nevents: int, categorical_columns: list) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    nvisitors = max(nevents // 5, 1)
+    visitor_ids = np.array(
+        [str(uuid.UUID(int=int(x))) for x in rng.integers(0, 2**63, nvisitors)]
+    )
+    ha_user_ids = np.char.add("u", rng.integers(1, nvisitors, nevents).astype(str))
+
+    raw_df = pd.DataFrame(
+        {
+            "event": rng.choice([f"event_{i}" for i in range(1, 6)], nevents),
+            "time": pd.Timestamp("2020-10-22")
+            + pd.to_timedelta(rng.integers(0, 86_400_000_000, nevents), unit="us"),
+            "unique_visitor_id": visitor_ids[rng.integers(0, nvisitors, nevents)],
+            "ha_user_id": np.where(rng.random(nevents) < 0.3, ha_user_ids, None),
+            "browser": rng.choice(["Chrome", "Safari", "Firefox", ""], nevents),
+            "os": rng.choice(["Windows", "Mac", "Android", ""], nevents),
+            "country_code": rng.choice(COUNTRY_CODES, nevents),
+        }
+    )
+    return raw_df.astype({col: "category" for col in categorical_columns})
+
+
+@click.command()
+@click.option("--nevents", default=1000000, show_default=True)
+@click.option("--workers", default="1,2,4,8", show_default=True)
+def main(nevents: int, workers: str):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Configuration is read by the worker processes as well
+        os.environ["HOUSINGANYWHERE_DATA_DIR"] = os.path.join(tmp_dir, "data")
+        os.environ["HOUSINGANYWHERE_REPORTS_DIR"] = os.path.join(tmp_dir, "reports")
+
+        from etl.core import _partition_by_visitor, clean_and_preprocess_data
+        from etl.utils import ETLStage, get_categorical_columns
+
+        raw_df = generate_raw_events(
+            nevents, categorical_columns=get_categorical_columns(ETLStage.raw)
+        )
+        click.echo(
+            f"{nevents:,} events, {raw_df['unique_visitor_id'].nunique():,} visitors, "
+            f"{os.cpu_count()} cpus"
+        )
+
+        baseline = None
+        for nworkers in [int(n) for n in workers.split(",")]:
+            payload = 0
+            if nworkers > 1:
+                shards = _partition_by_visitor(raw_df=raw_df, nshards=nworkers)
+                payload = sum(len(pickle.dumps(shard)) for shard in shards)
+
+            start = time.perf_counter()
+            clean_and_preprocess_data(raw_df, workers=nworkers)
+            elapsed = time.perf_counter() - start
+
+            baseline = baseline or elapsed
+            click.echo(
+                f"workers {nworkers:>2}  {elapsed:8.2f} s  "
+                f"speedup {baseline / elapsed:5.2f}x  "
+                f"shards {payload:>12,} bytes"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark size of `/v1/events/` responses with negotiated compression and the
+cost of replaying a closed time period with `If-None-Match`.
+
+Usage: python -m benchmarks.response_compression [--nevents 100000]
+"""
+
+import json
+import os
+import random
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import click
+
+from api import create_app
+from api.db import init_db
+from api.utils import get_supported_encodings
+
+TIMEPERIOD = "2020-10-22 00:00:00::2020-10-23 00:00:00"
+
+
+def generate_events(nevents: int) -> list:
+    random.seed(0)
+    visitor_ids = [str(uuid.uuid4()) for _ in range(max(nevents // 5, 1))]
+    start = datetime(2020, 10, 22)
+
+    events = []
+    for _ in range(nevents):
+        events.append(
+            {
+                "event": random.choice([f"event_{i}" for i in range(1, 6)]),
+                "properties": {
+                    "time": str(
+                        start + timedelta(microseconds=random.randrange(86_400_000_000))
+                    ),
+                    "unique_visitor_id": random.choice(visitor_ids),
+                    "ha_user_id": random.choice([None, f"u{random.randrange(10_000)}"]),
+                    "browser": random.choice(["Chrome", "Safari", "Firefox", None]),
+                    "os": random.choice(["Windows", "Mac", "Android", None]),
+                    "country_code": random.choice(["IT", "US", "United States", "NL"]),
+                },
+            }
+        )
+    return events
+
+
+def timed_get(client, headers: dict):
+    start = time.perf_counter()
+    response = client.get(
+        "/v1/events/", query_string={"timeperiod": TIMEPERIOD}, headers=headers
+    )
+    return response, time.perf_counter() - start
+
+
+@click.command()
+@click.option("--nevents", default=100000, show_default=True)
+def main(nevents: int):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_path = os.path.join(tmp_dir, "events_data.json")
+        with open(events_path, "w") as f:
+            json.dump(generate_events(nevents), f)
+
+        app = create_app()
+        app.config.update(
+            DATABASE=os.path.join(tmp_dir, "db.sqlite"), RAW_EVENTS_DATA=events_path
+        )
+        with app.app_context():
+            init_db()
+
+        client = app.test_client()
+
+        # Warm up the closed time period cache
+        identity, _ = timed_get(client, headers={"Accept-Encoding": "identity"})
+        identity_size = len(identity.get_data())
+        click.echo(f"{'identity':<10} {identity_size:>12,} bytes")
+
+        for encoding in get_supported_encodings():
+            response, elapsed = timed_get(client, headers={"Accept-Encoding": encoding})
+            size = len(response.get_data())
+            click.echo(
+                f"{encoding:<10} {size:>12,} bytes  ratio {identity_size / size:5.1f}x  "
+                f"{elapsed * 1000:8.1f} ms"
+            )
+
+            response, elapsed = timed_get(
+                client,
+                headers={
+                    "Accept-Encoding": encoding,
+                    "If-None-Match": response.headers["ETag"],
+                },
+            )
+            click.echo(
+                f"{encoding + ' 304':<10} {len(response.get_data()):>12,} bytes  "
+                f"status {response.status_code}  {elapsed * 1000:8.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
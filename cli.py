@@ -1,17 +1,19 @@
 from datetime import datetime
+from typing import Optional
 
 import click
-import pandas as pd
 
 from etl.config import get_config
 from etl.core import (
     build_report,
     clean_and_preprocess_data,
     fetch_events,
+    follow_events_feed,
+    import_calendar_dimension,
     import_preprocess_data,
 )
 from etl.db import init_analytics_schema
-from etl.io import flush, load
+from etl.io import flush, load_all, migrate
 from etl.utils import ETLStage
 
 etl_config = get_config()
@@ -53,17 +55,53 @@ def raw(start_time: datetime, end_time: datetime):
 
 
 @cli.command()
-def preprocess():
+def rawfeed():
+    """Fetch events inserted into HTTP Server since the last `rawfeed` run"""
+    export_paths = follow_events_feed()
+    for export_path in export_paths:
+        click.echo(f"Exported fetched events to {export_path}")
+
+    if not export_paths:
+        click.echo("Found no new events in events feed")
+
+
+@cli.command()
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of processes used to preprocess data sharded by visitor",
+)
+def preprocess(workers: int):
     """Preprocess data and exports it to intermediate data store"""
-    raw_data = pd.concat([x for x in load(etl_stage=ETLStage.raw)])
-    export_path = clean_and_preprocess_data(raw_data)
-    click.echo(f"Exported preprocess data to {export_path}")
+    raw_data = load_all(etl_stage=ETLStage.raw)
+    export_paths, conflicts_report_path = clean_and_preprocess_data(
+        raw_data, workers=workers
+    )
+    for export_path in export_paths:
+        click.echo(f"Exported preprocess data to {export_path}")
+    click.echo(f"Exported ha_user_id conflicts report at {conflicts_report_path}")
+
+
+@cli.command("migrate")
+@click.argument(
+    "etl-stage",
+    type=click.Choice(
+        [ETLStage.raw.name, ETLStage.preprocess.name], case_sensitive=False
+    ),
+)
+def migrate_command(etl_stage: str):
+    """Rewrite data files of particular etl stage written with older schema"""
+    nmigrated = migrate(etl_stage=ETLStage(etl_stage))
+    click.echo(f"Migrated {nmigrated} `{etl_stage}` data files to compact schema")
 
 
 @cli.command()
 def initdb():
     """Initialize `analytics` database by executing DDL queries"""
     init_analytics_schema()
+    import_calendar_dimension()
     click.echo("Initialized `analytics` database")
 
 
@@ -75,9 +113,27 @@ def importdb():
 
 
 @cli.command()
-def report():
+@click.option(
+    "--start-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Only consider events on or after this date",
+)
+@click.option(
+    "--end-date",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Only consider events on or before this date",
+)
+def report(start_date: Optional[datetime], end_date: Optional[datetime]):
     """Build sample report based on `analytics` DB"""
-    export_path = build_report()
+    export_path, rebuilt_sheets = build_report(
+        start_date=start_date.date() if start_date else None,
+        end_date=end_date.date() if end_date else None,
+    )
+    if not rebuilt_sheets:
+        click.echo(f"Report at {export_path} is up to date")
+        return
+
+    click.echo(f"Rebuilt sheets: {', '.join(rebuilt_sheets)}")
     click.echo(f"Exported report at {export_path}")
 
 
@@ -1,6 +1,7 @@
 import dataclasses
 import os
 import re
+from datetime import date
 from pathlib import Path
 
 __all__ = ["get_config"]
@@ -11,12 +12,30 @@ class Config:
     events_api_host: str = "127.0.0.1"
     events_api_port: str = "5000"
 
-    data_dir: Path = Path("/tmp/housinganywhere_data/")
+    # Can be overridden with `HOUSINGANYWHERE_DATA_DIR` and
+    # `HOUSINGANYWHERE_REPORTS_DIR` environment variables
+    data_dir: Path = Path(
+        os.environ.get("HOUSINGANYWHERE_DATA_DIR", "/tmp/housinganywhere_data/")
+    )
 
-    reports_dir: Path = Path("/tmp/housinganywhere_reports/")
+    reports_dir: Path = Path(
+        os.environ.get("HOUSINGANYWHERE_REPORTS_DIR", "/tmp/housinganywhere_reports/")
+    )
 
     events_timeperiod_date_format: str = "%Y-%m-%d %H:%M:%S"
 
+    # Number of events fetched per request while following events change feed
+    events_feed_page_size: int = 1000
+
+    # Date range of `event_date` calendar dimension generated by `initdb`
+    calendar_start_date: date = date(2020, 1, 1)
+    calendar_end_date: date = date(2025, 12, 31)
+
+    # Standard error of distinct visitor counts estimated from HyperLogLog sketches.
+    # Each sketch row stores 3 bytes per distinct visitor, up to `0.75 * 2^p` bytes
+    # where `p` is the precision i.e 12 KB for the default error of 0.01
+    distinct_count_error: float = 0.01
+
     ha_user_id_regex: re.Pattern = re.compile("(\d+)")
 
     etl_root_dir: str = os.path.dirname(os.path.abspath(__file__))
@@ -25,6 +44,12 @@ class Config:
     def events_api_url(self) -> str:
         return f"http://{self.events_api_host}:{self.events_api_port}"
 
+    @property
+    def reports_cache_dir(self) -> Path:
+        """Sheets of previous report builds, reused while their tables are
+        unchanged"""
+        return Path(self.reports_dir) / ".cache"
+
     @property
     def database_uri(self) -> str:
         return os.path.join(self.etl_root_dir, "analytics.sqlite")
@@ -40,5 +65,6 @@ def get_config() -> Config:
     # Create directory if missing
     os.makedirs(config.data_dir, exist_ok=True)
     os.makedirs(config.reports_dir, exist_ok=True)
+    os.makedirs(config.reports_cache_dir, exist_ok=True)
 
     return config
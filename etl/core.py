@@ -1,4 +1,9 @@
-from datetime import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -11,31 +16,293 @@ from pypika.enums import Order
 from pypika.terms import PseudoColumn
 
 from etl.config import get_config
-from etl.db import DBManager
-from etl.io import export_as_file, export_report, export_to_db, load
+from etl.db import DBManager, get_table_versions, stamp_table_version
+from etl.io import (
+    drop_known_keys,
+    export_as_file,
+    export_report,
+    export_to_db,
+    get_report_path,
+    load_all,
+    load_cached_report_sheet,
+    load_etag,
+    load_feed_cursor,
+    load_report_manifest,
+    remove_data_chunks,
+    remove_stale_data_chunks,
+    save_cached_report_sheet,
+    save_etag,
+    save_feed_cursor,
+    save_report_manifest,
+)
+from etl.sketches import (
+    build_sketches,
+    decode_registers,
+    encode_registers,
+    estimate_distinct_count,
+    get_precision,
+    merge_sketches,
+)
 from etl.utils import (
     ETLStage,
+    build_api_fetch_events_feed_url,
     build_api_fetch_events_url,
+    canonicalize_visitor_ids,
     country_to_continent,
+    get_categorical_columns,
     get_device_type,
 )
 
 __all__ = [
     "fetch_events",
+    "follow_events_feed",
     "clean_and_preprocess_data",
     "build_report",
     "import_preprocess_data",
+    "import_calendar_dimension",
 ]
 
+REPORT_NAME = "ha_sample_report"
+
 
 def fetch_events(start_time: datetime, end_time: datetime) -> str:
     """Fetch events data from the HTTP Server"""
     api_url = build_api_fetch_events_url(start_time, end_time)
-    r = requests.get(api_url)
+
+    # Responses of time periods fully in the past have ETag. Unchanged responses
+    # are not sent again by the HTTP Server
+    headers = {"Accept-Encoding": "gzip"}
+    etag = load_etag(etl_stage=ETLStage.raw, url=api_url)
+    if etag:
+        headers["If-None-Match"] = etag
+
+    r = requests.get(api_url, headers=headers)
+    if r.status_code == requests.codes.not_modified:
+        return None
 
     data = r.json()
 
-    events_df = pd.DataFrame(data.get("data", []))
+    execution_id = f"{start_time.isoformat()}_{end_time.isoformat()}".replace(
+        "-", ""
+    ).replace(":", "")
+    export_path = _export_raw_events(
+        events=data.get("data", []), execution_id=execution_id
+    )
+
+    if "ETag" in r.headers:
+        save_etag(etl_stage=ETLStage.raw, url=api_url, etag=r.headers["ETag"])
+
+    return export_path
+
+
+def follow_events_feed() -> List[str]:
+    """Fetch events inserted into the HTTP Server since the last followed sequence,
+    regardless of their event time. Pages through the change feed and persists the
+    sequence after every exported page"""
+    config = get_config()
+    limit = config.events_feed_page_size
+
+    export_paths = []
+    since = load_feed_cursor(etl_stage=ETLStage.raw)
+    while True:
+        api_url = build_api_fetch_events_feed_url(since=since, limit=limit)
+        r = requests.get(api_url, headers={"Accept-Encoding": "gzip"})
+
+        # Error responses have no events and must not pass for the end of feed
+        r.raise_for_status()
+
+        data = r.json()
+        events = data.get("data", [])
+        if not events:
+            break
+
+        next_since = data["next_since"]
+        export_path = _export_raw_events(
+            events=events, execution_id=f"seq_{since + 1}_{next_since}"
+        )
+        if export_path:
+            export_paths.append(export_path)
+
+        save_feed_cursor(etl_stage=ETLStage.raw, since=next_since)
+        since = next_since
+
+        if len(events) < limit:
+            break
+
+    return export_paths
+
+
+def clean_and_preprocess_data(
+    raw_data: pd.DataFrame, workers: int = 1
+) -> Tuple[List[str], str]:
+    """Clean and preprocess raw data. With more than one worker, the raw data is
+    hash partitioned by `unique_visitor_id` into shards which are preprocessed in
+    parallel and exported as separate data chunks. All cleaning rules only look at
+    rows of the same `unique_visitor_id` so output is same as with single worker.
+    Returns export paths of data chunks and of the user id conflicts report"""
+
+    # Data chunks of this run have their own execution ids. Data chunks of previous
+    # runs are only removed once every shard is exported
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+    if workers == 1:
+        shards = [raw_data]
+        execution_ids = [f"ha_{run_id}"]
+    else:
+        shards = _partition_by_visitor(raw_df=raw_data, nshards=workers)
+        execution_ids = [
+            f"ha_{run_id}_{shard_id:03d}" for shard_id in range(len(shards))
+        ]
+
+    try:
+        if workers == 1:
+            results = [_clean_and_export_shard(shards[0], execution_ids[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(_clean_and_export_shard, shards, execution_ids)
+                )
+    except Exception:
+        remove_data_chunks(etl_stage=ETLStage.preprocess, execution_ids=execution_ids)
+        raise
+
+    export_paths = [export_path for export_path, _ in results]
+    remove_stale_data_chunks(etl_stage=ETLStage.preprocess, export_paths=export_paths)
+
+    conflicts_df = pd.concat(
+        [shard_conflicts_df for _, shard_conflicts_df in results], ignore_index=True
+    ).sort_values(by=["unique_visitor_id", "dropped_ha_user_id"], ignore_index=True)
+
+    conflicts_report_path = export_report(
+        report_name="ha_user_id_conflicts",
+        reports_data={"User ID Conflicts": conflicts_df},
+    )
+    return export_paths, conflicts_report_path
+
+
+def import_preprocess_data():
+    # Fetch preprocess data
+    pdf = load_all(etl_stage=ETLStage.preprocess)
+
+    pdf = _import_device_details(pdf)
+
+    pdf = _import_users(pdf)
+
+    pdf = _import_locations(pdf)
+
+    pdf = _import_event_date_dimensions(pdf)
+
+    pdf = _import_visitor_sketches(pdf)
+
+    pdf = pdf.fillna(value="")
+
+    table = Table("events")
+    export_to_db(pdf, table)
+
+
+def import_calendar_dimension():
+    """Generate `event_date` calendar dimension for the configured date range"""
+    config = get_config()
+    _import_calendar_dates(
+        start_date=config.calendar_start_date, end_date=config.calendar_end_date
+    )
+
+
+def build_report(
+    start_date: Optional[date] = None, end_date: Optional[date] = None
+) -> Tuple[str, List[str]]:
+    """Build sample report for events between `start_date` and `end_date`. All
+    events are considered if the dates are not provided. Sheets of previous builds
+    are reused unless the tables they are built from changed. Returns report path
+    and names of the rebuilt sheets"""
+    date_key_range = _get_date_key_range(start_date=start_date, end_date=end_date)
+
+    # Sheets with their query builder, the function building sheet from the query
+    # results and the tables the query reads
+    sheets = {
+        "Events Per Country": (
+            _build_events_per_country_query,
+            _get_events_per_country,
+            ["events", "locations"],
+        ),
+        "Events by User Type": (
+            _build_events_by_user_type_query,
+            _get_events_by_user_type,
+            ["events", "users"],
+        ),
+        "Unique Visitors Per Country": (
+            _build_unique_visitors_per_country_query,
+            _get_unique_visitors_per_country,
+            ["location_visitor_sketches", "locations"],
+        ),
+        "Unique Visitors by User Type": (
+            _build_unique_visitors_by_user_type_query,
+            _get_unique_visitors_by_user_type,
+            ["user_type_visitor_sketches"],
+        ),
+    }
+    queries = {
+        sheet_name: build_query(date_key_range)
+        for sheet_name, (build_query, _, _) in sheets.items()
+    }
+
+    table_versions = get_table_versions(
+        [
+            table_name
+            for _, _, table_names in sheets.values()
+            for table_name in table_names
+        ]
+    )
+    cache_keys = {
+        sheet_name: _get_report_sheet_cache_key(
+            query=queries[sheet_name],
+            table_versions={
+                table_name: table_versions[table_name] for table_name in table_names
+            },
+        )
+        for sheet_name, (_, _, table_names) in sheets.items()
+    }
+
+    # Nothing changed since the last exported report
+    report_path = get_report_path(REPORT_NAME)
+    if load_report_manifest(REPORT_NAME) == cache_keys and os.path.exists(report_path):
+        return report_path, []
+
+    reports_data, rebuilt_sheets = {}, []
+    for sheet_name, (_, build_sheet, _) in sheets.items():
+        sheet_data = load_cached_report_sheet(REPORT_NAME, cache_keys[sheet_name])
+        if sheet_data is None:
+            sheet_data = build_sheet(queries[sheet_name])
+            save_cached_report_sheet(REPORT_NAME, cache_keys[sheet_name], sheet_data)
+            rebuilt_sheets.append(sheet_name)
+        reports_data[sheet_name] = sheet_data
+
+    export_path = export_report(report_name=REPORT_NAME, reports_data=reports_data)
+    save_report_manifest(REPORT_NAME, cache_keys)
+    return export_path, rebuilt_sheets
+
+
+#########################################################################
+# Local Helper Functions
+#########################################################################
+
+
+def _preprocess_country_column(df: pd.DataFrame) -> pd.DataFrame:
+    """Preprocess and cleanup country column. Replaces country_code to have consistent
+    country names across rows"""
+    # Lookup is done once per category instead of once per row
+    df["country"] = (
+        df["country_code"]
+        .map(lambda x: pycountry.countries.lookup(x).name)
+        .astype("category")
+    )
+    del df["country_code"]
+    return df
+
+
+def _export_raw_events(events: List[dict], execution_id: str) -> Optional[str]:
+    """Export events returned by the HTTP Server as `raw` data chunk. Events which
+    were already exported are skipped"""
+    events_df = pd.DataFrame(events)
 
     export_path = None
     if not events_df.empty:
@@ -57,9 +324,18 @@ def fetch_events(start_time: datetime, end_time: datetime) -> str:
             }
         )
 
-        execution_id = f"{start_time.isoformat()}_{end_time.isoformat()}".replace(
-            "-", ""
-        ).replace(":", "")
+        # Ids are hashed in the form they are read back from data chunks
+        events_df["unique_visitor_id"] = canonicalize_visitor_ids(
+            events_df["unique_visitor_id"].astype(str)
+        )
+        events_df = events_df.astype(
+            dtype={col: "category" for col in get_categorical_columns(ETLStage.raw)}
+        )
+
+        # Skip events already fetched by overlapping or retried windows
+        events_df = drop_known_keys(data=events_df, etl_stage=ETLStage.raw)
+
+    if not events_df.empty:
         export_path = export_as_file(
             data=events_df, etl_stage=ETLStage.raw, execution_id=execution_id
         )
@@ -67,7 +343,9 @@ def fetch_events(start_time: datetime, end_time: datetime) -> str:
     return export_path
 
 
-def clean_and_preprocess_data(raw_data: pd.DataFrame) -> str:
+def _clean_and_export_shard(
+    raw_data: pd.DataFrame, execution_id: str
+) -> Tuple[str, pd.DataFrame]:
     config = get_config()
 
     raw_data = raw_data.drop_duplicates()
@@ -86,65 +364,57 @@ def clean_and_preprocess_data(raw_data: pd.DataFrame) -> str:
 
     # Validate many-to-one relation between unique_visitor_id and ha_user_id
     # Make sure each `unique_visitor_id` should have single ha_user_id
-    raw_data = _remove_inconsistent_user_pairs(raw_df=raw_data)
+    keep_mask, conflicts_df = _resolve_inconsistent_user_pairs(raw_df=raw_data)
+    raw_data = raw_data.loc[keep_mask]
 
     # Replace `nan` with empty string
-    raw_data = raw_data.fillna(
-        value={col: "" for col in ["browser", "os", "ha_user_id"]}
-    )
+    raw_data = _fill_empty_string(df=raw_data, columns=["browser", "os", "ha_user_id"])
 
     export_path = export_as_file(
-        data=raw_data, etl_stage=ETLStage.preprocess, execution_id="ha"
+        data=raw_data, etl_stage=ETLStage.preprocess, execution_id=execution_id
     )
-    return export_path
-
-
-def import_preprocess_data():
-    # Fetch preprocess data
-    pdf = pd.concat([x for x in load(etl_stage=ETLStage.preprocess)])
-
-    pdf = _import_device_details(pdf)
-
-    pdf = _import_users(pdf)
+    return export_path, conflicts_df
 
-    pdf = _import_locations(pdf)
-
-    pdf = _import_event_date_dimensions(pdf)
 
-    pdf = pdf.fillna(value="")
-
-    table = Table("events")
-    export_to_db(pdf, table)
-
-
-def build_report() -> str:
-    export_path = export_report(
-        report_name="ha_sample_report",
-        reports_data={
-            "Events Per Country": _get_events_per_country(),
-            "Events by User Type": _get_events_by_user_type(),
-        },
+def _partition_by_visitor(raw_df: pd.DataFrame, nshards: int) -> List[pd.DataFrame]:
+    """Hash partition rows by `unique_visitor_id` so all rows of a visitor end up
+    in the same shard. Empty shards are skipped"""
+    visitor_hashes = pd.util.hash_pandas_object(
+        raw_df["unique_visitor_id"], index=False
     )
-    return export_path
-
+    shard_ids = (visitor_hashes % nshards).to_numpy()
+
+    # Categories not present in a shard are not sent to its worker
+    shards = []
+    for _, shard_df in raw_df.groupby(shard_ids, sort=True):
+        categorical_columns = shard_df.select_dtypes(include="category").columns
+        shards.append(
+            shard_df.assign(
+                **{
+                    col: shard_df[col].cat.remove_unused_categories()
+                    for col in categorical_columns
+                }
+            )
+        )
+    return shards
 
-#########################################################################
-# Local Helper Functions
-#########################################################################
 
+def _fill_empty_string(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Replace `nan` with empty string. Adds empty string as category for
+    categorical columns"""
+    for col in columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and (
+            "" not in df[col].cat.categories
+        ):
+            df[col] = df[col].cat.add_categories("")
 
-def _preprocess_country_column(df: pd.DataFrame) -> pd.DataFrame:
-    """Preprocess and cleanup country column. Replaces country_code to have consistent
-    country names across rows"""
-    df["country"] = df["country_code"].map(lambda x: pycountry.countries.lookup(x).name)
-    del df["country_code"]
-    return df
+    return df.fillna(value={col: "" for col in columns})
 
 
 def _fill_known_ha_user_id(raw_df: pd.DataFrame) -> pd.DataFrame:
     """Fill `ha_user_id` if we already know it based on `unique_visitor_id`"""
     df = raw_df[raw_df["ha_user_id"].notnull()]
-    user_df = df.groupby(by=["unique_visitor_id"], as_index=False).agg(
+    user_df = df.groupby(by=["unique_visitor_id"], as_index=False, observed=True).agg(
         {"ha_user_id": "first"}
     )
     user_df = user_df[["unique_visitor_id", "ha_user_id"]].rename(
@@ -157,37 +427,51 @@ def _fill_known_ha_user_id(raw_df: pd.DataFrame) -> pd.DataFrame:
     return raw_df
 
 
-def _remove_inconsistent_user_pairs(raw_df: pd.DataFrame) -> pd.DataFrame:
+def _resolve_inconsistent_user_pairs(
+    raw_df: pd.DataFrame,
+) -> Tuple[np.ndarray, pd.DataFrame]:
     """Validate many-to-one relation between unique_visitor_id and ha_user_id.
-    Remove the old inconsistent `unique_visitor_id` and `ha_user_id` pairs.
-    Make sure each `unique_visitor_id` should have single ha_user_id"""
-    df = raw_df[raw_df["ha_user_id"].notnull()]
-    df = df.groupby(by=["unique_visitor_id"], as_index=False).filter(
-        lambda g: (g["ha_user_id"].nunique() > 1)
+    Only the most recent `ha_user_id` of each `unique_visitor_id` is kept.
+    Returns positional mask of rows to keep and a report with one row per
+    conflicting visitor and dropped `ha_user_id`"""
+    conflicts_df = pd.DataFrame(
+        columns=["unique_visitor_id", "kept_ha_user_id", "dropped_ha_user_id"]
     )
-    if not df.empty:
-        print(f"Found inconsistency in {len(df)} rows")
-        print(
-            "Will only keep the latest unique pair of unique_visitor_id and ha_user_id"
-        )
+    keep_mask = np.ones(len(raw_df), dtype=bool)
 
-        # Find the most recent pair of unique_visitor_id and ha_user_id
-        latest_df = (
-            df.sort_values(by=["unique_visitor_id", "time"], ascending=[True, False])
-            .groupby(by=["unique_visitor_id"], as_index=False)
-            .agg({"ha_user_id": "first"})
-        )
+    nuser_ids = raw_df.groupby(by=["unique_visitor_id"], observed=True)[
+        "ha_user_id"
+    ].transform("nunique")
+    conflict_positions = np.flatnonzero(
+        (raw_df["ha_user_id"].notnull() & (nuser_ids > 1)).to_numpy()
+    )
+    if conflict_positions.size == 0:
+        return keep_mask, conflicts_df
+
+    df = raw_df.iloc[conflict_positions][
+        ["unique_visitor_id", "time", "ha_user_id"]
+    ].reset_index(drop=True)
+
+    # Find the most recent `ha_user_id` of each `unique_visitor_id`
+    df["kept_ha_user_id"] = (
+        df.sort_values(by=["time"], kind="mergesort")
+        .groupby(by=["unique_visitor_id"], observed=True)["ha_user_id"]
+        .transform("last")
+    )
 
-        # Delete unwanted rows
-        # Old pairs of inconsistent unique_visitor_id and ha_user_id
-        row_to_keep_df = pd.merge(
-            df, latest_df, on=["unique_visitor_id", "ha_user_id"], how="inner"
-        )
-        rows_to_delete_df = pd.concat([df, row_to_keep_df]).drop_duplicates(keep=False)
-        print(f"Deleting {len(rows_to_delete_df)} rows because of inconsistency")
+    # Old pairs of inconsistent unique_visitor_id and ha_user_id
+    is_dropped = (df["ha_user_id"] != df["kept_ha_user_id"]).to_numpy()
+    keep_mask[conflict_positions[is_dropped]] = False
 
-        raw_df = raw_df.loc[~raw_df.index.isin(rows_to_delete_df.index)]
-    return raw_df
+    conflicts_df = (
+        df.loc[is_dropped, ["unique_visitor_id", "kept_ha_user_id", "ha_user_id"]]
+        .rename(columns={"ha_user_id": "dropped_ha_user_id"})
+        .drop_duplicates()
+        .sort_values(by=["unique_visitor_id", "dropped_ha_user_id"], ignore_index=True)
+    )
+    conflicts_df["unique_visitor_id"] = conflicts_df["unique_visitor_id"].astype(str)
+
+    return keep_mask, conflicts_df
 
 
 def _fill_known_user_device_details(raw_df: pd.DataFrame) -> pd.DataFrame:
@@ -198,9 +482,9 @@ def _fill_known_user_device_details(raw_df: pd.DataFrame) -> pd.DataFrame:
     # `browser` and `os` exists as a pair
     # i.e either both columns will have values else both will be empty
     known_df = raw_df[(raw_df["browser"].notnull()) & (raw_df["os"].notnull())]
-    known_df = known_df.groupby(by=["unique_visitor_id"], as_index=False).agg(
-        {"browser": "first", "os": "first"}
-    )
+    # First known pair per visitor. Same as groupby `first` but stays vectorized
+    # for categorical columns
+    known_df = known_df.drop_duplicates(subset=["unique_visitor_id"])
     known_df = known_df[["unique_visitor_id", "browser", "os"]]
     known_df = known_df.rename(columns={"browser": "known_browser", "os": "known_os"})
 
@@ -226,8 +510,8 @@ def _add_device_type(raw_df: pd.DataFrame) -> pd.DataFrame:
     return raw_df
 
 
-def _get_events_per_country() -> pd.DataFrame:
-    """Compute number of events per country"""
+def _build_events_per_country_query(date_key_range: Tuple[int, int]) -> str:
+    """Query to compute number of events per country"""
 
     events_table = Table("events")
     locations_table = Table("locations")
@@ -238,13 +522,16 @@ def _get_events_per_country() -> pd.DataFrame:
         Query.from_(events_table)
         .left_join(locations_table)
         .on(events_table.location_key == locations_table.id)
+        .where(events_table.event_date_key[slice(*date_key_range)])
         .select(locations_table.country, fn.Count("*").as_("nevents"))
         .groupby(locations_table.country)
         .orderby(nevents, order=Order.desc)
         .orderby(locations_table.country, order=Order.asc)
     )
-    query = query.get_sql()
+    return query.get_sql()
+
 
+def _get_events_per_country(query: str) -> pd.DataFrame:
     db_manager = DBManager()
     data = db_manager.fetch(query)
     return pd.DataFrame(
@@ -253,8 +540,8 @@ def _get_events_per_country() -> pd.DataFrame:
     )
 
 
-def _get_events_by_user_type() -> pd.DataFrame:
-    """Compute number events for authenticated and unauthenticated users"""
+def _build_events_by_user_type_query(date_key_range: Tuple[int, int]) -> str:
+    """Query to compute number events for authenticated and unauthenticated users"""
     events_table = Table("events")
     users_table = Table("users")
 
@@ -269,6 +556,7 @@ def _get_events_by_user_type() -> pd.DataFrame:
         Query.from_(events_table)
         .left_join(users_table)
         .on(events_table.ha_user_key == users_table.id)
+        .where(events_table.event_date_key[slice(*date_key_range)])
         .select(
             iif(users_table.ha_user_id, "Authenticated", "Unauthenticated").as_(
                 user_type
@@ -278,9 +566,10 @@ def _get_events_by_user_type() -> pd.DataFrame:
         .groupby(user_type)
         .orderby(nevents, order=Order.desc)
     )
+    return query.get_sql()
 
-    query = query.get_sql()
 
+def _get_events_by_user_type(query: str) -> pd.DataFrame:
     db_manager = DBManager()
     data = db_manager.fetch(query)
     return pd.DataFrame(
@@ -289,6 +578,170 @@ def _get_events_by_user_type() -> pd.DataFrame:
     )
 
 
+def _get_date_key_range(
+    start_date: Optional[date], end_date: Optional[date]
+) -> Tuple[int, int]:
+    """Returns inclusive range of `event_date` keys between `start_date` and
+    `end_date`. Missing dates leave the range open"""
+    start_date = start_date or date.min
+    end_date = end_date or date.max
+    return (
+        start_date.year * 10000 + start_date.month * 100 + start_date.day,
+        end_date.year * 10000 + end_date.month * 100 + end_date.day,
+    )
+
+
+def _get_report_sheet_cache_key(
+    query: str, table_versions: Dict[str, Optional[str]]
+) -> str:
+    """Returns hash identifying the sheet query and data versions of the tables it
+    reads"""
+    cache_key = json.dumps(
+        {"query": query, "table_versions": table_versions}, sort_keys=True
+    )
+    return hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+
+
+def _build_unique_visitors_per_country_query(date_key_range: Tuple[int, int]) -> str:
+    """Query to fetch sketches of unique visitors per country"""
+    sketches_table = Table("location_visitor_sketches")
+    locations_table = Table("locations")
+
+    query = (
+        Query.from_(sketches_table)
+        .left_join(locations_table)
+        .on(sketches_table.location_key == locations_table.id)
+        .where(sketches_table.event_date_key[slice(*date_key_range)])
+        .select(
+            locations_table.country, sketches_table.precision, sketches_table.registers
+        )
+    )
+    return query.get_sql()
+
+
+def _get_unique_visitors_per_country(query: str) -> pd.DataFrame:
+    """Estimate number of unique visitors per country by merging sketches"""
+    db_manager = DBManager()
+    data = db_manager.fetch(query)
+    return _estimate_unique_visitors(data, columns=["country", "nvisitors"])
+
+
+def _build_unique_visitors_by_user_type_query(date_key_range: Tuple[int, int]) -> str:
+    """Query to fetch sketches of unique visitors for authenticated and
+    unauthenticated users"""
+    sketches_table = Table("user_type_visitor_sketches")
+
+    query = (
+        Query.from_(sketches_table)
+        .where(sketches_table.event_date_key[slice(*date_key_range)])
+        .select(
+            sketches_table.user_type, sketches_table.precision, sketches_table.registers
+        )
+    )
+    return query.get_sql()
+
+
+def _get_unique_visitors_by_user_type(query: str) -> pd.DataFrame:
+    """Estimate number of unique visitors for authenticated and unauthenticated
+    users by merging sketches"""
+    db_manager = DBManager()
+    data = db_manager.fetch(query)
+    return _estimate_unique_visitors(data, columns=["user_type", "nvisitors"])
+
+
+def _estimate_unique_visitors(data: List[tuple], columns: List[str]) -> pd.DataFrame:
+    """Merge sketches of each group and estimate number of unique visitors"""
+    group_sketches = {}
+    for group, precision, registers in data:
+        group_sketches.setdefault(group, []).append(
+            decode_registers(registers, precision=precision)
+        )
+
+    df = pd.DataFrame(
+        [
+            (group, estimate_distinct_count(merge_sketches(sketches)))
+            for group, sketches in group_sketches.items()
+        ],
+        columns=columns,
+    )
+    return df.sort_values(
+        by=[columns[1], columns[0]], ascending=[False, True], ignore_index=True
+    )
+
+
+def _import_visitor_sketches(preprocess_data: pd.DataFrame) -> pd.DataFrame:
+    """Add sketches of distinct visitors per date and location and per date and
+    user type. Sketches of already imported dates are merged with the new ones"""
+    pdf = preprocess_data
+    user_type = np.where(
+        pdf["ha_user_key"].notnull(), "Authenticated", "Unauthenticated"
+    )
+
+    _merge_visitor_sketches(
+        table_name="location_visitor_sketches",
+        visitor_ids=pdf["unique_visitor_id"],
+        groups=pdf[["event_date_key", "location_key"]],
+    )
+    _merge_visitor_sketches(
+        table_name="user_type_visitor_sketches",
+        visitor_ids=pdf["unique_visitor_id"],
+        groups=pd.DataFrame(
+            {"event_date_key": pdf["event_date_key"], "user_type": user_type}
+        ),
+    )
+
+    return pdf
+
+
+def _merge_visitor_sketches(
+    table_name: str, visitor_ids: pd.Series, groups: pd.DataFrame
+):
+    config = get_config()
+    precision = get_precision(error=config.distinct_count_error)
+
+    sketches = build_sketches(values=visitor_ids, groups=groups, precision=precision)
+    group_columns = groups.columns.tolist()
+
+    # Fetch already imported sketches of the same dates
+    table = Table(table_name)
+    query = (
+        Query.from_(table)
+        .select(*group_columns, table.precision, table.registers)
+        .where(table.event_date_key.isin(groups["event_date_key"].unique().tolist()))
+    )
+
+    db_manager = DBManager()
+    existing_sketches = {}
+    for *group, existing_precision, registers in db_manager.fetch(query.get_sql()):
+        if existing_precision != precision:
+            raise ValueError(
+                f"Cannot merge sketches of precision {existing_precision} and "
+                f"{precision} in `{table_name}`. Re-run `initdb` and `importdb`"
+            )
+        existing_sketches[tuple(group)] = decode_registers(
+            registers, precision=precision
+        )
+
+    rows = []
+    for group, registers in sketches.items():
+        group = tuple(
+            value.item() if hasattr(value, "item") else value for value in group
+        )
+        if group in existing_sketches:
+            registers = merge_sketches([registers, existing_sketches[group]])
+        rows.append((*group, precision, encode_registers(registers)))
+
+    columns = group_columns + ["precision", "registers"]
+    placeholders = ", ".join("?" for _ in columns)
+    db_manager.execute_many(
+        f"INSERT OR REPLACE INTO {table_name} ({', '.join(columns)}) "
+        f"VALUES ({placeholders})",
+        rows,
+    )
+    if rows:
+        stamp_table_version(table_name)
+
+
 def _import_device_details(preprocess_data: pd.DataFrame) -> pd.DataFrame:
     df = preprocess_data[["browser", "os"]]
 
@@ -364,30 +817,53 @@ def _import_locations(preprocess_data: pd.DataFrame) -> pd.DataFrame:
     return pdf
 
 
-def _import_event_date_dimensions(preprocess_data: pd.DataFrame) -> pd.DataFrame:
-    df = preprocess_data[["time"]]
-
-    df = df.drop_duplicates().reset_index(drop=True)
+def _import_calendar_dates(start_date: date, end_date: date):
+    """Insert calendar rows between `start_date` and `end_date` which are not yet
+    present in `event_date` dimension. Holidays are computed once for whole range"""
+    dates = pd.date_range(start=start_date, end=end_date, freq="D", normalize=True)
 
-    df.loc[:, "month"] = df["time"].dt.month_name()
-    df.loc[:, "year"] = df["time"].dt.year
-    df.loc[:, "date"] = df["time"].dt.date
-    df.loc[:, "day"] = df["time"].dt.day_name()
-    df.loc[:, "quarter"] = df["time"].dt.to_period("Q").astype(str)
+    db_manager = DBManager()
+    existing_keys = db_manager.fetch(
+        Query.from_(Table("event_date")).select("id").get_sql()
+    )
+    dates = dates[~_to_date_key(dates).isin([key for key, in existing_keys])]
+    if dates.empty:
+        return
 
     calendar = HolidayCalendar()
-    holidays = calendar.holidays(start=df["date"].min(), end=df["date"].max())
-    df.loc[:, "is_holiday"] = df["date"].isin(holidays)
+    holidays = calendar.holidays(start=dates.min(), end=dates.max())
+
+    df = pd.DataFrame(
+        {
+            "id": _to_date_key(dates),
+            "date": dates.date,
+            "month": dates.month_name(),
+            "year": dates.year,
+            "day": dates.day_name(),
+            "quarter": dates.to_period("Q").astype(str),
+            "is_holiday": dates.isin(holidays),
+        }
+    )
 
     table = Table("event_date")
     export_to_db(df, table)
 
-    df = df.reset_index().rename(columns={"index": "event_date_key"})
-    df["event_date_key"] += 1
 
-    pdf = pd.merge(
-        preprocess_data, df[["event_date_key", "time"]], on=["time"], how="left"
+def _to_date_key(dates: pd.DatetimeIndex) -> pd.Index:
+    """Convert dates to `YYYYMMDD` integer key of `event_date` dimension"""
+    return dates.year * 10000 + dates.month * 100 + dates.day
+
+
+def _import_event_date_dimensions(preprocess_data: pd.DataFrame) -> pd.DataFrame:
+    # Make sure calendar covers event dates outside configured range
+    _import_calendar_dates(
+        start_date=preprocess_data["time"].min(),
+        end_date=preprocess_data["time"].max(),
     )
+
+    pdf = preprocess_data
+    pdf["event_date_key"] = _to_date_key(pd.DatetimeIndex(pdf["time"])).to_numpy()
+    pdf["event_time"] = pdf["time"].dt.strftime("%H:%M:%S.%f")
     del pdf["time"]
 
     return pdf
@@ -1,5 +1,8 @@
 import sqlite3
-from typing import List
+import uuid
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from pypika import Query, Table
 
 from etl.config import get_config
 
@@ -24,6 +27,11 @@ class DBManager(object):
         cur = self.get_cursor()
         return cur.execute(query).fetchall()
 
+    def execute_many(self, query: str, params: Iterable[Sequence]):
+        """Execute parameterized query for each params and commit"""
+        with self.__db:
+            self.__db.executemany(query, params)
+
     def execute_script(self, script_path: str):
         with open(script_path, "rb") as f:
             self.__db.executescript(f.read().decode("utf-8"))
@@ -35,3 +43,29 @@ def init_analytics_schema():
     db_manager.execute_script(
         script_path=db_manager.config.analytics_schema_script_path
     )
+
+
+def stamp_table_version(table_name: str):
+    """Assign a new version to `table_name` after its data is loaded. Random
+    versions never repeat, even after `analytics` database is initialized again"""
+    db_manager = DBManager()
+    db_manager.execute_many(
+        "INSERT OR REPLACE INTO table_versions (table_name, version) VALUES (?, ?)",
+        [(table_name, uuid.uuid4().hex)],
+    )
+
+
+def get_table_versions(table_names: Iterable[str]) -> Dict[str, Optional[str]]:
+    """Returns current version of each table. Tables which are not loaded since
+    `analytics` database is initialized have no version"""
+    table_names = sorted(set(table_names))
+    table = Table("table_versions")
+    query = (
+        Query.from_(table)
+        .select(table.table_name, table.version)
+        .where(table.table_name.isin(table_names))
+    )
+
+    db_manager = DBManager()
+    versions = dict(db_manager.fetch(query.get_sql()))
+    return {table_name: versions.get(table_name) for table_name in table_names}
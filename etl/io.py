@@ -1,17 +1,52 @@
+import json
 import os
 from pathlib import Path
-from typing import Dict, Generator
+from typing import Dict, Generator, List, Optional
 
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
 from pypika import Query, Table
 
 from etl.config import get_config
-from etl.db import DBManager
-from etl.utils import ETLStage, get_data_schema, get_export_filename
+from etl.db import DBManager, stamp_table_version
+from etl.utils import (
+    PRIMARY_KEY_COLUMNS,
+    ETLStage,
+    decode_visitor_ids,
+    encode_visitor_ids,
+    get_categorical_columns,
+    get_data_schema,
+    get_etags_filename,
+    get_export_filename,
+    get_feed_cursor_filename,
+    get_key_index_filename,
+    hash_primary_keys,
+)
 
-__all__ = ["load", "flush", "export_as_file", "export_to_db", "export_report"]
+__all__ = [
+    "load",
+    "load_all",
+    "drop_known_keys",
+    "load_feed_cursor",
+    "save_feed_cursor",
+    "load_etag",
+    "save_etag",
+    "flush",
+    "remove_data_chunks",
+    "remove_stale_data_chunks",
+    "migrate",
+    "export_as_file",
+    "export_to_db",
+    "export_report",
+    "get_report_path",
+    "load_cached_report_sheet",
+    "save_cached_report_sheet",
+    "load_report_manifest",
+    "save_report_manifest",
+]
 
 
 def _get_files_by_etl_stage(etl_stage: ETLStage) -> Generator[str, None, None]:
@@ -20,29 +55,230 @@ def _get_files_by_etl_stage(etl_stage: ETLStage) -> Generator[str, None, None]:
     return Path(config.data_dir).glob(f"{etl_stage.name}__*.parquet")
 
 
+def _get_key_index_path(etl_stage: ETLStage) -> Path:
+    """Returns path of primary key index file of particular etl stage"""
+    config = get_config()
+    filename = get_key_index_filename(etl_stage=etl_stage)
+    return Path(config.data_dir) / f"{filename}.bin"
+
+
+def _is_legacy_file(filepath: str, etl_stage: ETLStage) -> bool:
+    """Checks whether data chunk was written with an older (plain string) schema"""
+    file_schema = pq.read_schema(filepath)
+    schema = get_data_schema(etl_stage)
+    return any(file_schema.field(field.name).type != field.type for field in schema)
+
+
+def _read_parquet(filepath: str, etl_stage: ETLStage) -> pd.DataFrame:
+    """Read data chunk with compact in-memory dtypes. Supports data chunks written
+    with an older (plain string) schema"""
+    schema = get_data_schema(etl_stage)
+    table = pq.read_table(filepath)
+
+    visitor_ids = table.column("unique_visitor_id")
+    df = table.drop(["unique_visitor_id"]).to_pandas()
+
+    if pa.types.is_fixed_size_binary(visitor_ids.type):
+        df["unique_visitor_id"] = decode_visitor_ids(visitor_ids)
+    else:
+        df["unique_visitor_id"] = visitor_ids.to_pandas()
+
+    df = df.astype(
+        dtype={col: "category" for col in get_categorical_columns(etl_stage)}
+    )
+    return df[schema.names]
+
+
+def _write_parquet(data: pd.DataFrame, schema: pa.Schema, export_path: str):
+    """Write data chunk using compact schema. `unique_visitor_id` is kept as plain
+    strings if any of the ids is not a UUID"""
+    visitor_ids_index = schema.get_field_index("unique_visitor_id")
+
+    table = pa.Table.from_pandas(
+        data.drop(columns=["unique_visitor_id"]),
+        schema=schema.remove(visitor_ids_index),
+        preserve_index=False,
+    )
+
+    visitor_ids_field = schema.field(visitor_ids_index)
+    visitor_ids = encode_visitor_ids(data["unique_visitor_id"])
+    if visitor_ids is None:
+        visitor_ids_field = visitor_ids_field.with_type(pa.string())
+        visitor_ids = pa.array(data["unique_visitor_id"].astype(str), pa.string())
+
+    table = table.add_column(visitor_ids_index, visitor_ids_field, visitor_ids)
+    pq.write_table(table, where=export_path)
+
+
 def load(etl_stage: ETLStage) -> Generator[pd.DataFrame, None, None]:
     """Loads data chunks based on etl stage"""
     files = _get_files_by_etl_stage(etl_stage=etl_stage)
     for filepath in files:
-        yield pd.read_parquet(filepath)
+        yield _read_parquet(filepath, etl_stage=etl_stage)
+
+
+def load_all(etl_stage: ETLStage) -> pd.DataFrame:
+    """Loads and concatenates all data chunks of particular etl stage. Categories are
+    unified across chunks so categorical columns are not upcasted to `object`"""
+    chunks: List[pd.DataFrame] = list(load(etl_stage=etl_stage))
+
+    for col in get_categorical_columns(etl_stage):
+        categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _append_key_index(data: pd.DataFrame, key_index_path: Path):
+    """Append sorted 64 bit hashes of primary keys of a data chunk to the key index"""
+    key_hashes = np.sort(hash_primary_keys(data)).astype("<u8")
+    with open(key_index_path, "ab") as f:
+        f.write(key_hashes.tobytes())
+
+
+def _build_key_index(etl_stage: ETLStage) -> Path:
+    """Build the key index from data chunks exported before it existed. Returns
+    path of the key index"""
+    key_index_path = _get_key_index_path(etl_stage=etl_stage)
+    if key_index_path.exists():
+        return key_index_path
+
+    # Build and rename so that an interrupted build is started again
+    tmp_path = key_index_path.with_suffix(".tmp")
+    tmp_path.write_bytes(b"")
+    for data in load(etl_stage=etl_stage):
+        _append_key_index(data, key_index_path=tmp_path)
+    os.replace(tmp_path, key_index_path)
+
+    return key_index_path
+
+
+def _load_key_index(etl_stage: ETLStage) -> np.ndarray:
+    """Returns key hashes of all exported data chunks"""
+    key_index_path = _build_key_index(etl_stage=etl_stage)
+
+    # Ignore partially appended hash of an interrupted export
+    nhashes = key_index_path.stat().st_size // 8
+    return np.fromfile(key_index_path, dtype="<u8", count=nhashes)
+
+
+def _load_keys_by_time_range(
+    etl_stage: ETLStage, start: pd.Timestamp, end: pd.Timestamp
+) -> pd.DataFrame:
+    """Returns primary keys of exported rows with `time` between `start` and `end`.
+    Only data chunks whose `time` statistics overlap the range are read"""
+    known_keys = []
+    for filepath in _get_files_by_etl_stage(etl_stage=etl_stage):
+        metadata = pq.read_metadata(filepath)
+        time_index = metadata.schema.to_arrow_schema().get_field_index("time")
+        overlaps = False
+        for row_group in range(metadata.num_row_groups):
+            stats = metadata.row_group(row_group).column(time_index).statistics
+            if stats is None or not stats.has_min_max:
+                overlaps = True
+            elif stats.min <= end and stats.max >= start:
+                overlaps = True
+
+        if overlaps:
+            data = _read_parquet(filepath, etl_stage=etl_stage)
+            data = data.loc[data["time"].between(start, end), PRIMARY_KEY_COLUMNS]
+            known_keys.append(data)
+
+    if not known_keys:
+        return pd.DataFrame(columns=PRIMARY_KEY_COLUMNS)
+
+    return pd.concat(known_keys, ignore_index=True)
+
+
+def drop_known_keys(data: pd.DataFrame, etl_stage: ETLStage) -> pd.DataFrame:
+    """Drop rows whose primary key already exists in exported data chunks. Key
+    hashes are matched first and only matching rows are compared exactly against
+    the data chunks"""
+    data = data.drop_duplicates(subset=PRIMARY_KEY_COLUMNS)
+    known_key_hashes = _load_key_index(etl_stage=etl_stage)
+    if len(known_key_hashes) == 0:
+        return data
+
+    key_hashes = hash_primary_keys(data)
+    is_candidate = np.isin(key_hashes, known_key_hashes)
+    if not is_candidate.any():
+        return data
+
+    # Exact comparison to rule out hash collisions
+    key_dtypes = {"event": str, "unique_visitor_id": str}
+    candidates_df = data.loc[is_candidate, PRIMARY_KEY_COLUMNS].astype(key_dtypes)
+    known_keys_df = (
+        _load_keys_by_time_range(
+            etl_stage=etl_stage,
+            start=candidates_df["time"].min(),
+            end=candidates_df["time"].max(),
+        )
+        .astype(key_dtypes)
+        .drop_duplicates()
+    )
+    is_known = (
+        pd.merge(candidates_df, known_keys_df, how="left", indicator=True)["_merge"]
+        == "both"
+    ).to_numpy()
+
+    keep_mask = ~is_candidate
+    keep_mask[np.flatnonzero(is_candidate)[~is_known]] = True
+    return data.loc[keep_mask]
 
 
 def export_as_file(data: pd.DataFrame, etl_stage: ETLStage, execution_id: str) -> str:
     """Export data in parquet format to intermediate data storage zone"""
     config = get_config()
-    schema = get_data_schema(etl_stage)
-    table = pa.Table.from_pandas(data, schema=schema)
     filename = get_export_filename(
         etl_stage=etl_stage,
         execution_id=execution_id,
     )
     export_path = config.data_dir / f"{filename}.parquet"
-    pq.write_table(table, where=export_path)
+
+    # Raw data chunks are deduplicated against primary key index of already
+    # exported data chunks. Keys are indexed before the data chunk is written so
+    # that an interrupted export only leaves hashes which do not match exactly
+    if etl_stage == ETLStage.raw:
+        key_index_path = _build_key_index(etl_stage=etl_stage)
+        _append_key_index(data, key_index_path=key_index_path)
+
+    _write_parquet(data, schema=get_data_schema(etl_stage), export_path=export_path)
+
     return export_path
 
 
+def migrate(etl_stage: ETLStage) -> int:
+    """Rewrite data chunks written with an older (plain string) schema using the
+    compact schema. Returns number of migrated data chunks"""
+    nmigrated = 0
+    files = _get_files_by_etl_stage(etl_stage=etl_stage)
+    for filepath in files:
+        if not _is_legacy_file(filepath, etl_stage=etl_stage):
+            continue
+
+        # Write and rename so that an interrupted migration keeps the data chunk
+        data = _read_parquet(filepath, etl_stage=etl_stage)
+        tmp_path = filepath.with_suffix(".tmp")
+        _write_parquet(data, schema=get_data_schema(etl_stage), export_path=tmp_path)
+
+        # Data chunks with ids which are not UUIDs may already be as compact
+        if pq.read_schema(tmp_path).equals(pq.read_schema(filepath)):
+            os.remove(tmp_path)
+            continue
+
+        os.replace(tmp_path, filepath)
+        nmigrated += 1
+
+    return nmigrated
+
+
 def export_to_db(data: pd.DataFrame, table: Table):
-    """Export data into database by performing bulk insert operation"""
+    """Export data into database by performing bulk insert operation. Version of
+    the table is only changed if rows are inserted"""
+    if data.empty:
+        return
+
     db_manager = DBManager()
     cursor = db_manager.get_cursor()
 
@@ -58,6 +294,63 @@ def export_to_db(data: pd.DataFrame, table: Table):
         f.write(";/n".join(sql_statements))
 
     cursor.executescript(";\n".join(sql_statements))
+    stamp_table_version(table.get_table_name())
+
+
+def _get_feed_cursor_path(etl_stage: ETLStage) -> Path:
+    config = get_config()
+    filename = get_feed_cursor_filename(etl_stage=etl_stage)
+    return Path(config.data_dir) / f"{filename}.txt"
+
+
+def load_feed_cursor(etl_stage: ETLStage) -> int:
+    """Returns last events API sequence exported by particular etl stage"""
+    cursor_path = _get_feed_cursor_path(etl_stage=etl_stage)
+    if not cursor_path.exists():
+        return 0
+
+    return int(cursor_path.read_text().strip())
+
+
+def save_feed_cursor(etl_stage: ETLStage, since: int):
+    """Persist last events API sequence exported by particular etl stage"""
+    cursor_path = _get_feed_cursor_path(etl_stage=etl_stage)
+    _write_text_atomically(cursor_path, str(since))
+
+
+def _get_etags_path(etl_stage: ETLStage) -> Path:
+    config = get_config()
+    filename = get_etags_filename(etl_stage=etl_stage)
+    return Path(config.data_dir) / f"{filename}.json"
+
+
+def load_etag(etl_stage: ETLStage, url: str) -> Optional[str]:
+    """Returns ETag of the last events API response exported from `url`"""
+    etags_path = _get_etags_path(etl_stage=etl_stage)
+    if not etags_path.exists():
+        return None
+
+    etags = json.loads(etags_path.read_text())
+    return etags.get(url)
+
+
+def save_etag(etl_stage: ETLStage, url: str, etag: str):
+    """Persist ETag of the events API response exported from `url`"""
+    etags_path = _get_etags_path(etl_stage=etl_stage)
+
+    etags = {}
+    if etags_path.exists():
+        etags = json.loads(etags_path.read_text())
+    etags[url] = etag
+
+    _write_text_atomically(etags_path, json.dumps(etags))
+
+
+def _write_text_atomically(path: Path, text: str):
+    """Write and rename so that file is never partially written"""
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
 
 
 def flush(etl_stage: ETLStage):
@@ -66,13 +359,88 @@ def flush(etl_stage: ETLStage):
     for filepath in files:
         os.remove(filepath)
 
+    for path in [
+        _get_key_index_path(etl_stage=etl_stage),
+        _get_feed_cursor_path(etl_stage=etl_stage),
+        _get_etags_path(etl_stage=etl_stage),
+    ]:
+        if path.exists():
+            os.remove(path)
 
-def export_report(report_name: str, reports_data: Dict[str, pd.DataFrame]) -> str:
+
+def remove_data_chunks(etl_stage: ETLStage, execution_ids: List[str]):
+    """Delete data chunks of particular etl stage exported by `execution_ids`"""
     config = get_config()
+    for execution_id in execution_ids:
+        filename = get_export_filename(etl_stage=etl_stage, execution_id=execution_id)
+        export_path = Path(config.data_dir) / f"{filename}.parquet"
+        if export_path.exists():
+            os.remove(export_path)
+
+
+def remove_stale_data_chunks(etl_stage: ETLStage, export_paths: List[str]):
+    """Delete data chunks of particular etl stage other than `export_paths`"""
+    export_paths = {Path(export_path) for export_path in export_paths}
+    for filepath in _get_files_by_etl_stage(etl_stage=etl_stage):
+        if filepath not in export_paths:
+            os.remove(filepath)
+
 
-    report_export_path = os.path.join(config.reports_dir, f"{report_name}.xlsx")
+def get_report_path(report_name: str) -> str:
+    config = get_config()
+    return os.path.join(config.reports_dir, f"{report_name}.xlsx")
+
+
+def export_report(report_name: str, reports_data: Dict[str, pd.DataFrame]) -> str:
+    report_export_path = get_report_path(report_name)
     with pd.ExcelWriter(report_export_path, engine="xlsxwriter") as writer:
         for sheet_name, sheet_data in reports_data.items():
             sheet_data.to_excel(writer, sheet_name=sheet_name, index_label="Row Num #")
 
     return report_export_path
+
+
+def _get_report_cache_dir(report_name: str) -> Path:
+    config = get_config()
+    cache_dir = Path(config.reports_cache_dir) / report_name
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def load_cached_report_sheet(
+    report_name: str, cache_key: str
+) -> Optional[pd.DataFrame]:
+    """Returns report sheet built previously for `cache_key` if present"""
+    sheet_path = _get_report_cache_dir(report_name) / f"{cache_key}.parquet"
+    if not sheet_path.exists():
+        return None
+
+    return pd.read_parquet(sheet_path)
+
+
+def save_cached_report_sheet(report_name: str, cache_key: str, data: pd.DataFrame):
+    sheet_path = _get_report_cache_dir(report_name) / f"{cache_key}.parquet"
+    tmp_path = sheet_path.with_suffix(".tmp")
+    data.to_parquet(tmp_path)
+    os.replace(tmp_path, sheet_path)
+
+
+def load_report_manifest(report_name: str) -> Dict[str, str]:
+    """Returns cache key of each sheet of the last exported report"""
+    manifest_path = _get_report_cache_dir(report_name) / "manifest.json"
+    if not manifest_path.exists():
+        return {}
+
+    return json.loads(manifest_path.read_text())
+
+
+def save_report_manifest(report_name: str, manifest: Dict[str, str]):
+    """Persist cache key of each sheet of the exported report. Cached sheets which
+    are not part of the report anymore are deleted"""
+    cache_dir = _get_report_cache_dir(report_name)
+    _write_text_atomically(cache_dir / "manifest.json", json.dumps(manifest))
+
+    cache_keys = set(manifest.values())
+    for sheet_path in cache_dir.glob("*.parquet"):
+        if sheet_path.stem not in cache_keys:
+            os.remove(sheet_path)
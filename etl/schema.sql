@@ -3,16 +3,20 @@ DROP TABLE IF EXISTS device_details;
 DROP TABLE IF EXISTS locations;
 DROP TABLE IF EXISTS event_date;
 DROP TABLE IF EXISTS users;
+DROP TABLE IF EXISTS location_visitor_sketches;
+DROP TABLE IF EXISTS user_type_visitor_sketches;
+DROP TABLE IF EXISTS table_versions;
 
 -- Facts table
 CREATE TABLE events ( 
 	event                varchar(36) NOT NULL    ,
 	event_date_key       integer NOT NULL    ,
+	event_time           time NOT NULL    ,
 	unique_visitor_id    varchar(64) NOT NULL    ,
 	ha_user_key          integer     ,
 	location_key         integer NOT NULL    ,
 	device_key           integer     ,
-	CONSTRAINT PrimaryKey PRIMARY KEY ( event, event_date_key, unique_visitor_id ),
+	CONSTRAINT PrimaryKey PRIMARY KEY ( event, event_date_key, event_time, unique_visitor_id ),
 	FOREIGN KEY ( device_key ) REFERENCES device_details( id )  ,
 	FOREIGN KEY ( location_key ) REFERENCES locations( id )  ,
 	FOREIGN KEY ( ha_user_key ) REFERENCES users( id )  ,
@@ -50,9 +54,9 @@ CREATE TABLE users (
  );
 
 
+-- Calendar at date grain, `id` is the date as `YYYYMMDD` integer
 CREATE TABLE event_date ( 
-	id                   integer NOT NULL  PRIMARY KEY  AUTOINCREMENT   ,
-	time                 datetime NOT NULL    ,
+	id                   integer NOT NULL  PRIMARY KEY   ,
 	date                 date NOT NULL    ,
 	month                varchar(36) NOT NULL    ,
 	is_holiday           boolean NOT NULL    ,
@@ -61,3 +65,38 @@ CREATE TABLE event_date (
 	day                  varchar(36) NOT NULL    ,
 	CONSTRAINT Pk_event_date UNIQUE ( id ) 
  );
+
+
+-- HyperLogLog sketches of distinct `unique_visitor_id`. Sketches are merged
+-- across incremental loads and date ranges by taking max of the registers.
+-- Registers are stored as sparse (index, rank) pairs while they are smaller than
+-- 6 bits packed registers (see `etl/sketches.py`)
+
+CREATE TABLE location_visitor_sketches ( 
+	event_date_key       integer NOT NULL    ,
+	location_key         integer NOT NULL    ,
+	precision            integer NOT NULL    ,
+	registers            blob NOT NULL    ,
+	CONSTRAINT Pk_location_visitor_sketches PRIMARY KEY ( event_date_key, location_key ),
+	FOREIGN KEY ( location_key ) REFERENCES locations( id )  ,
+	FOREIGN KEY ( event_date_key ) REFERENCES event_date( id )  
+ );
+
+
+CREATE TABLE user_type_visitor_sketches ( 
+	event_date_key       integer NOT NULL    ,
+	user_type            varchar(36) NOT NULL    ,
+	precision            integer NOT NULL    ,
+	registers            blob NOT NULL    ,
+	CONSTRAINT Pk_user_type_visitor_sketches PRIMARY KEY ( event_date_key, user_type ),
+	FOREIGN KEY ( event_date_key ) REFERENCES event_date( id )  
+ );
+
+
+-- Version of each table is replaced whenever its data is loaded. Report sheets
+-- are cached per versions of the tables they are built from
+
+CREATE TABLE table_versions ( 
+	table_name           varchar(64) NOT NULL  PRIMARY KEY   ,
+	version              varchar(36) NOT NULL    
+ );
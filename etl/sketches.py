@@ -0,0 +1,131 @@
+"""HyperLogLog sketches to estimate distinct counts. Sketches of the same precision
+can be merged by taking the element-wise maximum of their registers.
+
+Registers are stored sparse, as sorted (index, rank) pairs of 3 bytes each, while
+that is smaller than packing all `2^p` registers into 6 bits each."""
+
+import math
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    "get_precision",
+    "build_sketches",
+    "merge_sketches",
+    "estimate_distinct_count",
+    "encode_registers",
+    "decode_registers",
+]
+
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+# First byte of encoded registers
+SPARSE_ENCODING = 0
+PACKED_ENCODING = 1
+
+
+def get_precision(error: float) -> int:
+    """Returns number of index bits `p` so that standard error `1.04 / sqrt(2^p)` is
+    within `error`"""
+    nregisters = (1.04 / error) ** 2
+    precision = math.ceil(math.log2(nregisters))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+def _count_leading_zeros(values: np.ndarray) -> np.ndarray:
+    """Count leading zeros of unsigned 64 bit integers"""
+    values = values.copy()
+    nzeros = np.zeros(len(values), dtype=np.uint8)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        is_zero = (values >> np.uint64(64 - shift)) == 0
+        nzeros[is_zero] += shift
+        values[is_zero] <<= np.uint64(shift)
+
+    # All bits are zero
+    nzeros[values == 0] = 64
+    return nzeros
+
+
+def build_sketches(
+    values: pd.Series, groups: pd.DataFrame, precision: int
+) -> pd.Series:
+    """Build a sketch of distinct `values` for each group of `groups` columns.
+    Returns registers of each sketch indexed by group"""
+    hashes = pd.util.hash_pandas_object(values.astype(str), index=False).to_numpy()
+
+    # First `precision` bits select the register and rank is the position of first
+    # set bit in remaining bits
+    register_index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    remaining_bits = hashes << np.uint64(precision)
+    rank = np.minimum(_count_leading_zeros(remaining_bits) + 1, 64 - precision + 1)
+
+    group_codes, group_values = pd.MultiIndex.from_frame(groups).factorize()
+    registers = np.zeros((len(group_values), 1 << precision), dtype=np.uint8)
+    np.maximum.at(registers, (group_codes, register_index), rank.astype(np.uint8))
+
+    return pd.Series(list(registers), index=group_values)
+
+
+def merge_sketches(sketches: Iterable[np.ndarray]) -> np.ndarray:
+    """Merge sketches of the same precision"""
+    return np.maximum.reduce(list(sketches))
+
+
+def estimate_distinct_count(registers: np.ndarray) -> int:
+    nregisters = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / nregisters)
+    estimate = alpha * nregisters**2 / np.sum(np.power(2.0, -registers.astype(float)))
+
+    # Small range correction i.e linear counting
+    nempty = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * nregisters and nempty > 0:
+        estimate = nregisters * math.log(nregisters / nempty)
+
+    return int(round(estimate))
+
+
+def encode_registers(registers: np.ndarray) -> bytes:
+    """Encode registers as sorted (index, rank) pairs of non-zero registers if
+    smaller, otherwise as 6 bits per register. Ranks never exceed 61 so they fit
+    in 6 bits"""
+    indices = np.flatnonzero(registers)
+    if 3 * len(indices) < len(registers) * 3 // 4:
+        return (
+            bytes([SPARSE_ENCODING])
+            + indices.astype("<u2").tobytes()
+            + registers[indices].astype(np.uint8).tobytes()
+        )
+
+    # Pack each 4 registers of 6 bits into 3 bytes
+    r0, r1, r2, r3 = registers.astype(np.uint8).reshape(-1, 4).T
+    packed = np.stack(
+        [(r0 << 2) | (r1 >> 4), (r1 << 4) | (r2 >> 2), (r2 << 6) | r3], axis=1
+    )
+    return bytes([PACKED_ENCODING]) + packed.tobytes()
+
+
+def decode_registers(encoded: bytes, precision: int) -> np.ndarray:
+    """Decode registers encoded by `encode_registers`"""
+    nregisters = 1 << precision
+    encoding, data = encoded[0], np.frombuffer(encoded, dtype=np.uint8, offset=1)
+    registers = np.zeros(nregisters, dtype=np.uint8)
+    if encoding == SPARSE_ENCODING:
+        npairs = len(data) // 3
+        indices = data[: 2 * npairs].view("<u2")
+        registers[indices] = data[2 * npairs :]
+        return registers
+
+    b0, b1, b2 = data.reshape(-1, 3).T
+    registers.reshape(-1, 4)[:] = np.stack(
+        [
+            b0 >> 2,
+            ((b0 & 0x03) << 4) | (b1 >> 4),
+            ((b1 & 0x0F) << 2) | (b2 >> 6),
+            b2 & 0x3F,
+        ],
+        axis=1,
+    )
+    return registers
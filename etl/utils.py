@@ -1,7 +1,11 @@
+import uuid
 from datetime import datetime
 from enum import Enum, unique
+from typing import List, Optional
 from urllib.parse import ParseResult, urlencode, urljoin, urlparse
 
+import numpy as np
+import pandas as pd
 import pyarrow as pa
 import pycountry_convert as pc
 
@@ -14,6 +18,10 @@ class ETLStage(Enum):
     preprocess = "preprocess"
 
 
+# Same as primary key of `raw_events` table of the events API
+PRIMARY_KEY_COLUMNS = ["event", "time", "unique_visitor_id"]
+
+
 @unique
 class DeviceType(Enum):
     mobile = "mobile"
@@ -44,10 +52,43 @@ def build_api_fetch_events_url(start_time: datetime, end_time: datetime) -> str:
     return api_url
 
 
+def build_api_fetch_events_feed_url(since: int, limit: int) -> str:
+    config = get_config()
+
+    base_url = urljoin(config.events_api_url, "/v1/events/")
+    parsed_base_url = urlparse(base_url)
+
+    params = {"since": since, "limit": limit}
+    encoded_params = urlencode(params)
+
+    api_url = ParseResult(
+        parsed_base_url.scheme,
+        parsed_base_url.netloc,
+        parsed_base_url.path,
+        parsed_base_url.params,
+        encoded_params,
+        parsed_base_url.fragment,
+    ).geturl()
+
+    return api_url
+
+
 def get_export_filename(etl_stage: ETLStage, execution_id: str) -> str:
     return f"{etl_stage.name}__{execution_id}"
 
 
+def get_key_index_filename(etl_stage: ETLStage) -> str:
+    return f"{etl_stage.name}_keys"
+
+
+def get_feed_cursor_filename(etl_stage: ETLStage) -> str:
+    return f"{etl_stage.name}_feed_cursor"
+
+
+def get_etags_filename(etl_stage: ETLStage) -> str:
+    return f"{etl_stage.name}_etags"
+
+
 def get_device_type(browser: str, os: str) -> str:
     device_type = DeviceType.unknown
     mobile_os = set(["android"])
@@ -81,19 +122,85 @@ def country_to_continent(country_name: str) -> str:
 
 
 def get_data_schema(etl_stage: ETLStage) -> pa.schema:
+    # Low cardinality columns are dictionary encoded and `unique_visitor_id` is
+    # stored as raw 16 bytes UUID instead of 36 chars string
+    dictionary_string = pa.dictionary(pa.int32(), pa.string())
 
     schema_base_fields = [
-        ("event", pa.string()),
+        ("event", dictionary_string),
         ("time", pa.timestamp("ns")),
-        ("unique_visitor_id", pa.string()),
+        ("unique_visitor_id", pa.binary(16)),
         ("ha_user_id", pa.string()),
-        ("browser", pa.string()),
-        ("os", pa.string()),
+        ("browser", dictionary_string),
+        ("os", dictionary_string),
     ]
 
     schema_store = {
-        etl_stage.raw: schema_base_fields + [("country_code", pa.string())],
-        etl_stage.preprocess: schema_base_fields + [("country", pa.string())],
+        etl_stage.raw: schema_base_fields + [("country_code", dictionary_string)],
+        etl_stage.preprocess: schema_base_fields + [("country", dictionary_string)],
     }
     schema = schema_store[etl_stage]
     return pa.schema(schema)
+
+
+def hash_primary_keys(data: pd.DataFrame) -> np.ndarray:
+    """Returns 64 bit hash of primary key of each row"""
+    return pd.util.hash_pandas_object(data[PRIMARY_KEY_COLUMNS], index=False).to_numpy()
+
+
+def get_categorical_columns(etl_stage: ETLStage) -> List[str]:
+    """Returns columns which are kept as `category` dtype in memory"""
+    schema = get_data_schema(etl_stage)
+    columns = [field.name for field in schema if pa.types.is_dictionary(field.type)]
+    return columns + ["unique_visitor_id"]
+
+
+def _canonicalize_visitor_id(visitor_id: str) -> str:
+    try:
+        return str(uuid.UUID(visitor_id))
+    except ValueError as _:
+        return visitor_id
+
+
+def canonicalize_visitor_ids(visitor_ids: pd.Series) -> pd.Series:
+    """Rewrite UUID `unique_visitor_id` into canonical lowercase form, the same form
+    decoded from 16 bytes binary. Ids which are not UUIDs are kept as is"""
+    codes, uniques = pd.factorize(visitor_ids)
+    canonical_uniques = pd.Index(
+        [_canonicalize_visitor_id(visitor_id) for visitor_id in uniques]
+    )
+    return pd.Series(
+        canonical_uniques.take(codes), index=visitor_ids.index, name=visitor_ids.name
+    )
+
+
+def encode_visitor_ids(visitor_ids: pd.Series) -> Optional[pa.Array]:
+    """Encode `unique_visitor_id` UUID strings into 16 bytes fixed size binary array.
+    Each distinct id is parsed only once. Returns `None` if any id is not a UUID in
+    canonical form, as it would not be decoded back to the same string"""
+    codes, uniques = pd.factorize(visitor_ids)
+    encoded_uniques = []
+    for visitor_id in uniques:
+        try:
+            visitor_uuid = uuid.UUID(visitor_id)
+        except ValueError as _:
+            return None
+
+        if str(visitor_uuid) != visitor_id:
+            return None
+        encoded_uniques.append(visitor_uuid.bytes)
+
+    encoded_uniques = pa.array(encoded_uniques, type=pa.binary(16))
+    return encoded_uniques.take(pa.array(codes))
+
+
+def decode_visitor_ids(visitor_ids: pa.ChunkedArray) -> pd.Categorical:
+    """Decode 16 bytes fixed size binary array into categorical of UUID strings"""
+    encoded = visitor_ids.combine_chunks().dictionary_encode()
+    categories = [
+        str(uuid.UUID(bytes=visitor_id))
+        for visitor_id in encoded.dictionary.to_pylist()
+    ]
+    return pd.Categorical.from_codes(
+        encoded.indices.to_numpy(zero_copy_only=False), categories=categories
+    )